@@ -0,0 +1,82 @@
+"""
+Benchmark of :py:meth:`multipla.Multipla.dispatch` against the per-item loop.
+
+It formats a batch of interleaved ``(content type, object)`` items, by looking
+up each item implementation (as in the README), and by dispatching the whole
+batch to plain and to batch capable implementations::
+
+    python bench_multipla.py [items] [repeat]
+"""
+import json
+import sys
+import timeit
+
+import multipla
+
+CONTENT_TYPES = ('application/json', 'text/plain', 'text/x-repr')
+
+
+class Formatter(object):
+    def __init__(self, format):
+        self.format = format
+
+
+class BatchFormatter(object):
+    def __init__(self, format):
+        self._format = format
+
+    @multipla.batch
+    def format(self, objects):
+        format = self._format
+        return [format(o) for o in objects]
+
+
+def content_types(formatter):
+    "Returns a :py:class:`multipla.Multipla` of ``formatter`` instances."
+    plugs = multipla.Multipla('bench.content_types')
+    for name, format in zip(CONTENT_TYPES, (json.dumps, str, repr)):
+        plugs.switch_on(name).plug_in(name, formatter(format))
+    return plugs
+
+
+def loop(plugs, items):
+    return [plugs.get(t).format(o) for t, o in items]
+
+
+def dispatch(plugs, items):
+    return plugs.dispatch(items, 'format')
+
+
+CASES = (('loop', loop, Formatter),
+         ('dispatch', dispatch, Formatter),
+         ('dispatch batch', dispatch, BatchFormatter))
+
+
+def bench(size=10000, repeat=5):
+    """Returns the best timings (in seconds) of each strategy.
+
+    :raises AssertionError:             If strategies disagree on results.
+    """
+    items = [(CONTENT_TYPES[i % len(CONTENT_TYPES)], {'item': i})
+             for i in range(size)]
+    timings = dict()
+    expected = loop(content_types(Formatter), items)
+    for name, strategy, formatter in CASES:
+        plugs = content_types(formatter)
+        assert strategy(plugs, items) == expected
+        timer = timeit.Timer(lambda: strategy(plugs, items))
+        timings[name] = min(timer.repeat(repeat, 1))
+    return timings
+
+
+def main(size=10000, repeat=5):
+    timings = bench(size, repeat)
+    for name in sorted(timings, key=timings.get):
+        seconds = timings[name]
+        print('{:>24}: {:>10.6f}s {:>12.0f} items/s'.format(
+            name, seconds, size / seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
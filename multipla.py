@@ -44,7 +44,7 @@ handle multiple implementation of multiple plugins trough just a single class.
 #     SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 __author__ = "Luca De Vitis <luca at monkeython.com>"
-__version__ = '0.3.3'
+__version__ = '0.4.0'
 __keywords__ = ['multipla', 'multi-plugs', 'multi-socket', 'plugs', 'plugin']
 __classifiers__ = [
     'Development Status :: 5 - Production/Stable',
@@ -62,12 +62,23 @@ __classifiers__ = [
 
 __all__ = ['power_up']
 
+import binascii
+import bisect
 import collections
+import contextlib
 import functools
 import importlib
+import itertools
+import json
+import os
+import py_compile
 import sys
-
-import pkg_resources
+import sysconfig
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
 
 try:
     thread = importlib.import_module('thread')
@@ -80,11 +91,70 @@ except ImportError:     # pragma: no cover
         except ImportError:
             thread = importlib.import_module('_dummy_thread')
 
+try:
+    contextvars = importlib.import_module('contextvars')
+except ImportError:     # pragma: no cover
+    contextvars = None
+
+try:
+    futures = importlib.import_module('concurrent.futures')
+except ImportError:     # pragma: no cover
+    futures = None
+
+try:
+    _MAGIC_NUMBER = importlib.import_module('importlib.util').MAGIC_NUMBER
+except (ImportError, AttributeError):     # pragma: no cover
+    _MAGIC_NUMBER = importlib.import_module('imp').get_magic()
+
 PY2 = sys.version_info[0] == 2
 
 iteritems = lambda o: iter(o.iteritems() if PY2 else o.items())
 iterkeys = lambda o: iter(o.iterkeys() if PY2 else o.keys())
 
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _pkg_resources():
+    """Returns :py:mod:`pkg_resources`, importing it on first use.
+
+    Importing it scans all the available distributions, to build the default
+    working set: groups powered up from a bundle only (see :py:func:`freeze`)
+    don't pay for that.
+    """
+    return importlib.import_module('pkg_resources')
+
+
+def _sizeof(instance):
+    "Returns the size of ``instance`` in bytes, or 0 if it can't tell."
+    return sys.getsizeof(instance, 0)
+
+
+class _ThreadLocalVar(object):     # pragma: no cover
+    "A thread-local stand-in for :py:class:`contextvars.ContextVar`."
+
+    def __init__(self, name, default):
+        self.name = name
+        self._default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+def _context_var(name, default):
+    "Returns a context variable, or a thread-local one if unsupported."
+    if contextvars is None:     # pragma: no cover
+        return _ThreadLocalVar(name, default)
+    return contextvars.ContextVar(name, default=default)
+
 
 def _public2(method):
     @functools.wraps(method)
@@ -150,9 +220,120 @@ def _viewratings(instance):
     return collections.ItemsView(instance._ratings)
 
 
+class Metrics(object):
+    """Runtime metrics collector.
+
+    :param callback:                    An optional callable, invoked as
+                                        ``callback(event, key, value)`` for
+                                        each recorded counter increment or
+                                        observation. Events raised by the
+                                        callback itself (e.g. by calling
+                                        :py:meth:`snapshot`) are recorded, but
+                                        not notified to it again.
+
+    Assign an instance of this class to a :py:class:`RatedDict` trough
+    :py:meth:`RatedDict.instrument` to start collecting counters (e.g. how many
+    times :py:meth:`Multipla.get` hits or misses a socket), histograms (e.g.
+    how many seconds callers wait for, or hold, a :py:class:`Lock`) and memory
+    estimates. Instrumentation is opt-in: when no :py:class:`Metrics` instance
+    is assigned, the only overhead is an attribute check.
+    """
+
+    #: Upper bounds (in seconds) of the histogram buckets. The last bucket
+    #: collects everything above the highest bound.
+    bounds = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._counters = dict()
+        self._histograms = dict()
+        self._watched = dict()
+        self._locked = thread.allocate_lock()
+        self._notifying = threading.local()
+
+    def _notify_(self, event, key, value):
+        if self.callback is None or getattr(self._notifying, 'busy', False):
+            return
+        self._notifying.busy = True
+        try:
+            self.callback(event, key, value)
+        finally:
+            self._notifying.busy = False
+
+    def count(self, event, key=None, amount=1):
+        """Increment the ``event`` counter for ``key`` by ``amount``."""
+        with self._locked:
+            counters = self._counters.setdefault(event, dict())
+            counters[key] = counters.get(key, 0) + amount
+        self._notify_(event, key, amount)
+
+    def observe(self, event, value, key=None):
+        """Record ``value`` into the ``event`` histogram for ``key``."""
+        bucket = bisect.bisect_left(self.bounds, value)
+        with self._locked:
+            histograms = self._histograms.setdefault(event, dict())
+            try:
+                histogram = histograms[key]
+            except KeyError:
+                histogram = histograms[key] = {
+                    'count': 0, 'sum': 0, 'max': 0,
+                    'buckets': [0] * (len(self.bounds) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+            histogram['buckets'][bucket] += 1
+        self._notify_(event, key, value)
+
+    def watch(self, key, rated_dict):
+        """Report the memory footprint of ``rated_dict`` as ``key``.
+
+        Only a weak reference to ``rated_dict`` is kept.
+        """
+        with self._locked:
+            self._watched[key] = weakref.ref(rated_dict)
+
+    def snapshot(self):
+        """Returns a copy of the collected metrics.
+
+        :returns:                       A :py:class:`dict` with the
+                                        ``counters``, ``histograms`` and
+                                        ``memory`` keys, each one mapping
+                                        events (or watched keys) to their
+                                        values.
+        """
+        with self._locked:
+            counters = dict((event, dict(counters))
+                            for event, counters in iteritems(self._counters))
+            histograms = dict()
+            for event, by_key in iteritems(self._histograms):
+                histograms[event] = dict(
+                    (key, dict(histogram, buckets=list(histogram['buckets'])))
+                    for key, histogram in iteritems(by_key))
+            watched = list(iteritems(self._watched))
+        memory = dict()
+        for key, reference in watched:
+            rated_dict = reference()
+            if rated_dict is not None:
+                memory[key] = rated_dict.footprint()
+        return {'counters': counters,
+                'histograms': histograms,
+                'memory': memory}
+
+
 class Lock(object):
+    """A context manager lock.
+
+    When :py:attr:`Lock.metrics` is set, the time spent waiting for and holding
+    the lock is observed as ``lock.wait`` and ``lock.hold`` events, labeled
+    with :py:attr:`Lock.name`.
+    """
+
+    metrics = None
+    name = None
+
     def __init__(self):
         self.__lock = thread.allocate_lock()
+        self.__timings = None
 
     if PY2:
         def __nonzero__(self):
@@ -162,10 +343,42 @@ class Lock(object):
             return self.__lock.locked()
 
     def __enter__(self):
+        if self.metrics is None:
+            self.__lock.acquire()
+            return
+        started = _timer()
         self.__lock.acquire()
+        self.__timings = started, _timer()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        timings, self.__timings = self.__timings, None
         self.__lock.release()
+        # Observations (and the user callback with them) must happen out of
+        # the critical section.
+        metrics = self.metrics
+        if metrics is not None and timings is not None:
+            started, acquired = timings
+            metrics.observe('lock.wait', acquired - started, self.name)
+            metrics.observe('lock.hold', _timer() - acquired, self.name)
+
+
+class StripedLock(object):
+    """A fixed set of :py:class:`Lock`, striped by key.
+
+    :param int size:                    The number of stripes.
+
+    Item access returns the :py:class:`Lock` guarding the given (hashable)
+    key: the same key always gets the same lock, while different keys most
+    likely get different locks, so they don't contend with each other.
+    """
+    def __init__(self, size=32):
+        self._locks = tuple(Lock() for stripe in range(size))
+
+    def __getitem__(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+    def __len__(self):
+        return len(self._locks)
 
 
 class RatedDict(collections.Mapping):
@@ -180,7 +393,12 @@ class RatedDict(collections.Mapping):
     * ``__str__``
     * ``__eq__``, ``__ne__``
     * ``update``
+
+    It also supports opt-in runtime metrics, see :py:meth:`instrument`.
     """
+
+    metrics = None
+
     def __init__(self):
         self._ratings = collections.OrderedDict()
         self._dict = dict()
@@ -312,6 +530,41 @@ class RatedDict(collections.Mapping):
         """
         return self._ratings[key]
 
+    def _rated_(self):
+        "Returns a list of ``(key, rating, value)``, sorted by rating."
+        with self.locked:
+            return [(k, r, self._dict[k]) for k, r in self._ratings.items()]
+
+    def instrument(self, metrics, label=None):
+        """Start (or stop) collecting runtime metrics.
+
+        :param metrics:                 A :py:class:`Metrics` instance, or
+                                        ``None`` to stop collecting.
+        :param str label:               The key used to label the collected
+                                        metrics. Defaults to ``str(self)``.
+        """
+        if label is None:
+            label = str(self)
+        self.metrics = self.locked.metrics = metrics
+        self.locked.name = label
+
+    def footprint(self):
+        """Returns an estimate of the memory held by the container, in bytes.
+
+        Keys and values are measured shallowly, but :py:class:`RatedDict`
+        values are measured by their own :py:meth:`footprint`.
+        """
+        with self.locked:
+            items = list(self._dict.items())
+            size = _sizeof(self._dict) + _sizeof(self._ratings)
+        for key, value in items:
+            size += _sizeof(key)
+            if isinstance(value, RatedDict):
+                size += value.footprint()
+            else:
+                size += _sizeof(value)
+        return size
+
     if PY2:
         iterkeys = _public2(_iterkeys)
         itervalues = _public2(_itervalues)
@@ -332,6 +585,637 @@ class RatedDict(collections.Mapping):
         ratings = _public3(_viewratings)
 
 
+_references = dict()
+
+
+def _resolve(reference):
+    """Returns the object referenced as ``module:attrs``.
+
+    :raises ValueError:                 If ``reference`` is not in the
+                                        ``module:attrs`` form.
+
+    Resolved objects are cached, so that each worker process imports and
+    looks up a given implementation just once.
+    """
+    try:
+        return _references[reference]
+    except KeyError:
+        pass
+    module_name, colon, attrs = reference.partition(':')
+    if not colon:
+        error = 'invalid reference {!r}, expected "module:attrs"'
+        raise ValueError(error.format(reference))
+    plug = importlib.import_module(module_name)
+    for attr in attrs.split('.') if attrs else ():
+        plug = getattr(plug, attr)
+    _references[reference] = plug
+    return plug
+
+
+def _call(reference, args, kwargs):
+    return _resolve(reference)(*args, **kwargs)
+
+
+def _call_batch(reference, calls):
+    plug = _resolve(reference)
+    return [plug(*args, **kwargs) for args, kwargs in calls]
+
+
+def _call_star(reference, *args):
+    return _resolve(reference)(*args)
+
+
+_pools = dict()
+_locked_pools = Lock()
+
+
+def _managed_pool(executor, max_workers):
+    with _locked_pools:
+        try:
+            return _pools[executor]
+        except KeyError:
+            if futures is None:     # pragma: no cover
+                error = '{}: concurrent.futures missing'
+                raise RuntimeError(error.format(executor))
+            pool = _pools[executor] = getattr(futures, executor)(max_workers)
+            return pool
+
+
+def _shutdown_pool(executor, wait):
+    with _locked_pools:
+        pool = _pools.pop(executor, None)
+    if pool is not None:
+        pool.shutdown(wait)
+
+
+def process_pool(max_workers=None):
+    """Returns the process pool managed by this module.
+
+    :param int max_workers:             The number of worker processes, used
+                                        only when the pool is created.
+                                        Defaults to the number of CPUs.
+    :rtype:                             :py:class:`ProcessPoolExecutor`
+    :raises RuntimeError:               If :py:mod:`concurrent.futures` is not
+                                        available (on Python 2, install the
+                                        ``futures`` distribution).
+
+    The pool is created on first call and it's shared by all the
+    :py:class:`ProcessPlug` without an explicit executor.
+    """
+    return _managed_pool('ProcessPoolExecutor', max_workers)
+
+
+def shutdown_process_pool(wait=True):
+    """Shut down the process pool managed by this module, if any.
+
+    A new one will be created by the next call to :py:func:`process_pool`.
+    """
+    _shutdown_pool('ProcessPoolExecutor', wait)
+
+
+def thread_pool(max_workers=None):
+    """Returns the thread pool managed by this module.
+
+    :rtype:                             :py:class:`ThreadPoolExecutor`
+
+    It's shared by all the :py:class:`Hedge` without an explicit executor.
+    See :py:func:`process_pool`.
+    """
+    return _managed_pool('ThreadPoolExecutor', max_workers)
+
+
+def shutdown_thread_pool(wait=True):
+    """Shut down the thread pool managed by this module, if any.
+
+    A new one will be created by the next call to :py:func:`thread_pool`.
+    """
+    _shutdown_pool('ThreadPoolExecutor', wait)
+
+
+class ProcessPlug(object):
+    """A plug whose calls are executed out of process.
+
+    :param str reference:               The ``module:attrs`` reference of the
+                                        implementation, as recorded by
+                                        :py:meth:`Multipla.__call__`.
+    :param local:                       The in-process implementation, if any.
+    :param executor:                    A :py:class:`concurrent.futures`
+                                        executor. Defaults to the managed
+                                        :py:func:`process_pool`.
+    :raises ValueError:                 If ``reference`` is not in the
+                                        ``module:attrs`` form.
+
+    Only the reference and the call arguments are sent to the workers, which
+    resolve (and cache) the implementation by themselves: so arguments and
+    results must be picklable, but the implementation need not. Besides being
+    callable, it supports submitting calls as futures, batching many calls
+    into a single submission and mapping over many inputs in chunks.
+    """
+    def __init__(self, reference, local=None, executor=None):
+        if ':' not in reference:
+            error = 'invalid reference {!r}, expected "module:attrs"'
+            raise ValueError(error.format(reference))
+        self.reference = reference
+        self.local = local
+        self._executor = executor
+
+    def __repr__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.reference)
+
+    @property
+    def executor(self):
+        """The executor the calls are submitted to."""
+        if self._executor is None:
+            return process_pool()
+        return self._executor
+
+    def __call__(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
+
+    def submit(self, *args, **kwargs):
+        """Submit a single call.
+
+        :rtype:                         :py:class:`concurrent.futures.Future`
+        """
+        return self.executor.submit(_call, self.reference, args, kwargs)
+
+    def submit_batch(self, calls):
+        """Submit many calls as a single task.
+
+        :param calls:                   An iterable of ``(args, kwargs)``
+                                        pairs.
+        :returns:                       A :py:class:`concurrent.futures.Future`
+                                        of the list of results, in order.
+        """
+        calls = [(tuple(args), dict(kwargs)) for args, kwargs in calls]
+        return self.executor.submit(_call_batch, self.reference, calls)
+
+    def map(self, *iterables, **kwargs):
+        """Like :py:func:`map`, but calls are executed out of process.
+
+        :param int chunksize:           The number of calls sent to a worker
+                                        at once (keyword argument only).
+                                        Defaults to 1.
+        :returns:                       An iterator of results, in order.
+        """
+        chunksize = kwargs.pop('chunksize', 1)
+        if kwargs:
+            error = '{}.map: unexpected keyword arguments {}'
+            raise TypeError(error.format(self, sorted(kwargs)))
+        call = functools.partial(_call_star, self.reference)
+        return self.executor.map(call, *iterables, chunksize=chunksize)
+
+
+class Hedge(object):
+    """Hedged invocation of the top rated implementations of a socket.
+
+    :param adapter:                     The :py:class:`MultiPlugAdapter` (or
+                                        :py:class:`AdapterOverlay`) holding
+                                        interchangeable implementations.
+    :param float delay:                 How many seconds to wait for an
+                                        implementation to answer, before firing
+                                        the next one. Defaults to 0.05.
+    :param float percentile:            If given, the delay is this percentile
+                                        (0 to 100) of the recently observed
+                                        latencies of the first fired
+                                        implementation, once there are at
+                                        least :py:attr:`warmup` of them.
+    :param int amount:                  The maximum number of implementations
+                                        to fire, as per
+                                        :py:meth:`RatedDict.top`. Defaults
+                                        to 2.
+    :param executor:                    A :py:class:`concurrent.futures`
+                                        executor. Defaults to the managed
+                                        :py:func:`thread_pool`.
+    :param int window:                  How many recent latencies to keep.
+
+    Calling a hedge calls the highest rated implementation and, if it doesn't
+    answer within the delay, the next one concurrently, and so on. The first
+    successful result wins and the losers are cancelled: those already running
+    in a thread can't be interrupted, but their results are discarded. If an
+    implementation fails, the next one is fired right away; if all of them
+    fail, the last error is raised. From :py:mod:`asyncio` code, use
+    :py:meth:`acall` instead.
+    """
+
+    #: How many latencies to observe before using the ``percentile``.
+    warmup = 20
+
+    def __init__(self, adapter, delay=0.05, percentile=None, amount=2,
+                 executor=None, window=100):
+        self.adapter = adapter
+        self.delay = delay
+        self.percentile = percentile
+        self.amount = amount
+        self._executor = executor
+        self._latencies = collections.deque(maxlen=window)
+        self._stats = {'calls': 0, 'hedged': 0, 'hedges': 0, 'failovers': 0,
+                       'failures': 0, 'wins': dict()}
+        self._locked = thread.allocate_lock()
+
+    @property
+    def executor(self):
+        """The executor the calls are submitted to."""
+        if self._executor is None:
+            return thread_pool()
+        return self._executor
+
+    def _delay_(self):
+        if self.percentile is None:
+            return self.delay
+        with self._locked:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.warmup:
+            return self.delay
+        return latencies[int(self.percentile / 100.0 * (len(latencies) - 1))]
+
+    def _candidates_(self):
+        candidates = self.adapter.top(min(self.amount, len(self.adapter)))
+        if not candidates:
+            error = '{}.hedge: empty container'
+            raise ValueError(error.format(self.adapter))
+        return candidates
+
+    def _record_(self, key, hedges, failovers):
+        with self._locked:
+            stats = self._stats
+            stats['calls'] += 1
+            stats['hedged'] += 1 if hedges else 0
+            stats['hedges'] += hedges
+            stats['failovers'] += failovers
+            if key is None:
+                stats['failures'] += 1
+            else:
+                stats['wins'][key] = stats['wins'].get(key, 0) + 1
+
+    def _observe_(self, latency):
+        with self._locked:
+            self._latencies.append(latency)
+
+    def _primary_(self, started):
+        "Returns a done callback, observing the first fired implementation."
+        # The latency of the winner would drift low, as hedging cuts the
+        # slow calls short: the first fired implementation is observed
+        # instead, when it completes, even if it lost. If it was cancelled,
+        # the time it got is a lower bound of its latency.
+        def observe(future):
+            if future.cancelled() or future.exception() is None:
+                self._observe_(_timer() - started)
+        return observe
+
+    def stats(self):
+        """Returns a copy of the hedging statistics.
+
+        :returns:                       A :py:class:`dict` with the number of
+                                        ``calls``, of calls that fired at least
+                                        one hedge (``hedged``), of fired
+                                        ``hedges``, of implementations fired
+                                        because of a failure (``failovers``),
+                                        of calls where all implementations
+                                        failed (``failures``) and of ``wins``
+                                        for each implementation.
+        """
+        with self._locked:
+            return dict(self._stats, wins=dict(self._stats['wins']))
+
+    def __call__(self, *args, **kwargs):
+        candidates = self._candidates_()
+        delay = self._delay_()
+        started = _timer()
+        hedges = failovers = 0
+        pending = dict()
+        fire = 1
+        while True:
+            for index in range(fire):
+                key, plug = candidates.pop(0)
+                future = self.executor.submit(plug, *args, **kwargs)
+                if not (hedges or failovers):
+                    future.add_done_callback(self._primary_(started))
+                pending[future] = key
+            timeout = delay if candidates else None
+            done = futures.wait(pending, timeout, futures.FIRST_COMPLETED)[0]
+            for future in done:
+                key = pending.pop(future)
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    self._record_(key, hedges, failovers)
+                    return future.result()
+            if not (pending or candidates):
+                self._record_(None, hedges, failovers)
+                return future.result()
+            # Replace each failed implementation right away (failover), even
+            # if others are still pending, or fire the next candidate if the
+            # delay expired (hedge).
+            if done:
+                fire = min(len(done), len(candidates))
+                failovers += fire
+            else:
+                fire = 1
+                hedges += 1
+
+    def acall(self, *args, **kwargs):
+        """Like calling the hedge, but for :py:mod:`asyncio` callers.
+
+        :returns:                       An :py:class:`asyncio.Future` of the
+                                        winning result, to be awaited.
+
+        It must be called from a running event loop. Coroutine functions
+        are awaited in the event loop, while the other implementations are run
+        in the executor.
+        """
+        return _AsyncHedge(self, args, kwargs).result
+
+
+class _AsyncHedge(object):
+    "The state of a hedged call made trough :py:meth:`Hedge.acall`."
+
+    def __init__(self, hedge, args, kwargs):
+        self.asyncio = importlib.import_module('asyncio')
+        try:
+            self.loop = self.asyncio.get_running_loop()
+        except AttributeError:      # pragma: no cover
+            # Python < 3.7
+            self.loop = self.asyncio.get_event_loop()
+        self.hedge = hedge
+        self.args = args
+        self.kwargs = kwargs
+        self.candidates = hedge._candidates_()
+        self.delay = hedge._delay_()
+        self.started = _timer()
+        self.hedges = self.failovers = 0
+        self.pending = dict()
+        self.timer = None
+        self.result = self.loop.create_future()
+        self.result.add_done_callback(self._finish)
+        self._fire()
+
+    def _fire(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        key, plug = self.candidates.pop(0)
+        # The first fired implementation is observed as it completes, even
+        # after losing: so executor calls are observed trough their own
+        # future, that outlives the cancellation of the asyncio one.
+        if self.asyncio.iscoroutinefunction(plug):
+            task = observed = self.loop.create_task(
+                plug(*self.args, **self.kwargs))
+        else:
+            observed = self.hedge.executor.submit(plug, *self.args,
+                                                  **self.kwargs)
+            task = self.asyncio.wrap_future(observed, loop=self.loop)
+        if not (self.hedges or self.failovers):
+            observed.add_done_callback(self.hedge._primary_(self.started))
+        self.pending[task] = key
+        task.add_done_callback(self._settle)
+        if self.candidates:
+            self.timer = self.loop.call_later(self.delay, self._hedge)
+
+    def _hedge(self):
+        self.timer = None
+        if not self.result.done():
+            self.hedges += 1
+            self._fire()
+
+    def _settle(self, task):
+        key = self.pending.pop(task)
+        if self.result.done():
+            if not task.cancelled():
+                task.exception()    # Retrieved, as it doesn't matter.
+            return
+        if not task.cancelled() and task.exception() is None:
+            self.hedge._record_(key, self.hedges, self.failovers)
+            self.result.set_result(task.result())
+        elif self.candidates:
+            self.failovers += 1
+            self._fire()
+        elif self.pending:
+            return
+        else:
+            self.hedge._record_(None, self.hedges, self.failovers)
+            if task.cancelled():
+                self.result.cancel()
+            else:
+                self.result.set_exception(task.exception())
+
+    def _finish(self, result):
+        if self.timer is not None:
+            self.timer.cancel()
+        for task in list(self.pending):
+            task.cancel()
+
+
+def _memo_key(args, kwargs):
+    "Returns the cache key of a call, telling apart arguments types."
+    key = tuple((arg, type(arg)) for arg in args)
+    if kwargs:
+        key += (frozenset((k, v, type(v)) for k, v in kwargs.items()),)
+    return key
+
+
+class Memo(object):
+    """Memoized calls to the highest rated implementation of a socket.
+
+    :param adapter:                     The :py:class:`MultiPlugAdapter` (or
+                                        :py:class:`AdapterOverlay`) holding
+                                        the implementations.
+    :param int maxsize:                 The maximum number of results to keep.
+                                        Defaults to 128. If ``None``, the
+                                        number of results is unbounded.
+    :param int maxbytes:                If given, the maximum estimated size
+                                        of the results to keep, in bytes.
+    :param str attribute:               If given, the attribute of the
+                                        implementation to call (e.g. ``format``)
+                                        instead of the implementation itself.
+    :raises ValueError:                 If ``maxsize`` is less than 1.
+
+    Meant for pure implementations, repeatedly called with the same (hashable)
+    arguments. Like :py:func:`functools.lru_cache` with ``typed=True``,
+    arguments of different types are cached separately (e.g. ``1``, ``1.0``
+    and ``True``). The least recently used results are evicted first, when
+    either bound is exceeded. Results are bound to the identity of the highest
+    rated implementation: when it changes (e.g. after ``rate`` or
+    ``plug_in``), the cache is invalidated at the next call.
+    """
+    def __init__(self, adapter, maxsize=128, maxbytes=None, attribute=None):
+        if maxsize is not None and maxsize < 1:
+            error = 'Memo: maxsize must be at least 1, got {!r}'
+            raise ValueError(error.format(maxsize))
+        self.adapter = adapter
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.attribute = attribute
+        self._plug = None
+        self._cache = collections.OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'invalidations': 0}
+        self._locked = thread.allocate_lock()
+
+    def _lookup_(self, plug, key):
+        with self._locked:
+            if plug is not self._plug:
+                if self._cache:
+                    self._stats['invalidations'] += 1
+                self._clear_(plug)
+            try:
+                result, size = self._cache.pop(key)
+            except KeyError:
+                self._stats['misses'] += 1
+                raise
+            self._cache[key] = result, size
+            self._stats['hits'] += 1
+            return result
+
+    def _store_(self, plug, key, result):
+        size = _sizeof(result) if self.maxbytes is not None else 0
+        with self._locked:
+            if plug is not self._plug:
+                return
+            self._cache[key] = result, size
+            self._bytes += size
+            while self._cache and (
+                    self.maxsize is not None and
+                    len(self._cache) > self.maxsize or
+                    self.maxbytes is not None and self._bytes > self.maxbytes):
+                self._bytes -= self._cache.popitem(last=False)[1][1]
+                self._stats['evictions'] += 1
+
+    def _clear_(self, plug):
+        self._plug = plug
+        self._cache.clear()
+        self._bytes = 0
+
+    def __call__(self, *args, **kwargs):
+        plug = self.adapter.highest_rated
+        key = _memo_key(args, kwargs)
+        try:
+            return self._lookup_(plug, key)
+        except KeyError:
+            pass
+        call = plug if self.attribute is None else getattr(plug, self.attribute)
+        result = call(*args, **kwargs)
+        self._store_(plug, key, result)
+        return result
+
+    def clear(self):
+        """Drop all the memoized results."""
+        with self._locked:
+            self._clear_(None)
+
+    def stats(self):
+        """Returns a copy of the memoization statistics.
+
+        :returns:                       A :py:class:`dict` with the number of
+                                        ``hits``, ``misses``, ``evictions``
+                                        and ``invalidations``, the ``hit_rate``
+                                        and the current ``size`` and (if
+                                        ``maxbytes`` is given) ``bytes``.
+        """
+        with self._locked:
+            stats = dict(self._stats, size=len(self._cache))
+            if self.maxbytes is not None:
+                stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+
+def batch(plug):
+    """Declare ``plug`` as batch capable.
+
+    A batch capable plug takes a list of items and returns the list of the
+    respective results, in the same order. This function only sets the
+    ``__multipla_batch__`` attribute of ``plug`` to ``True``, so plugin
+    distributions can set it by themselves, without depending on
+    :py:mod:`multipla`. Use it as a decorator:
+
+    .. code-block:: python
+
+       @multipla.batch
+       def encode(objects):
+           return [json.dumps(o) for o in objects]
+    """
+    plug.__multipla_batch__ = True
+    return plug
+
+
+def _is_batch(plug):
+    return getattr(plug, '__multipla_batch__', False) is True
+
+
+def _chunks(iterable, size):
+    "Yields lists of ``size`` items (the last one may be shorter)."
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _call_batch_plug(plug, items):
+    results = plug(items)
+    if not isinstance(results, list):
+        results = list(results)
+    if len(results) != len(items):
+        error = '{!r}: got {} results for {} items'
+        raise ValueError(error.format(plug, len(results), len(items)))
+    return results
+
+
+def _call_batch_item(plug, item):
+    return _call_batch_plug(plug, [item])[0]
+
+
+def _call_each(plug, items):
+    return [plug(item) for item in items]
+
+
+class Pipeline(object):
+    """A streaming pipeline of plugin implementations.
+
+    :param stages:                      The sequence of implementations: each
+                                        one gets the results of the previous
+                                        one.
+    :param int chunksize:               If given, items are processed in lists
+                                        of (at most) ``chunksize`` items, stage
+                                        after stage.
+    :raises ValueError:                 If ``chunksize`` is less than 1.
+
+    Calling a pipeline with an iterable of items returns a generator of the
+    results, so memory usage doesn't depend on the input size. A stage
+    declared as batch capable (see :py:func:`batch`) is called once per chunk,
+    with a list of items, instead of once per item.
+    """
+    def __init__(self, stages, chunksize=None):
+        if chunksize is not None and chunksize < 1:
+            error = 'Pipeline: chunksize must be at least 1, got {!r}'
+            raise ValueError(error.format(chunksize))
+        self.stages = list(stages)
+        self.chunksize = chunksize
+
+    def __call__(self, items):
+        if self.chunksize is None:
+            stages = [functools.partial(_call_batch_item, stage)
+                      if _is_batch(stage) else stage
+                      for stage in self.stages]
+            for item in items:
+                for stage in stages:
+                    item = stage(item)
+                yield item
+        else:
+            stages = [functools.partial(_call_batch_plug
+                                        if _is_batch(stage) else _call_each,
+                                        stage)
+                      for stage in self.stages]
+            for chunk in _chunks(items, self.chunksize):
+                for stage in stages:
+                    chunk = stage(chunk)
+                for item in chunk:
+                    yield item
+
+
 class MultiPlugAdapter(RatedDict):
     """The multi-plug adapter that holds all the plugin implementations.
 
@@ -345,10 +1229,21 @@ class MultiPlugAdapter(RatedDict):
     for example, 2 distributions might provide the same ``YAML`` serialization
     functions, but each using a different ``YAML`` library.
     """
+
+    _offloaded = False
+    _executor = None
+
     def __init__(self, name):
         self.name = name
+        self._memos = dict()
         super(MultiPlugAdapter, self).__init__()
 
+    def _setitem_(self, key, value):
+        if (self._offloaded and ':' in key
+                and not isinstance(value, ProcessPlug)):
+            value = ProcessPlug(key, value, self._executor)
+        return super(MultiPlugAdapter, self)._setitem_(key, value)
+
     def plug_in(self, name, plug):
         """Try to plug an object in.
 
@@ -368,6 +1263,146 @@ class MultiPlugAdapter(RatedDict):
         error = '{}.plug_in: {} is already set with {}'
         raise KeyError(error.format(self, name, value))
 
+    def hedged(self, *args, **kwargs):
+        """Returns a :py:class:`Hedge` of this socket implementations.
+
+        Arguments are passed to :py:class:`Hedge`.
+        """
+        return Hedge(self, *args, **kwargs)
+
+    def memoized(self, maxsize=128, maxbytes=None, attribute=None):
+        """Returns a :py:class:`Memo` of this socket implementations.
+
+        Arguments are passed to :py:class:`Memo`. The same :py:class:`Memo`
+        is returned for the same arguments, so the memoized results are
+        shared by all the callers.
+        """
+        key = maxsize, maxbytes, attribute
+        with self.locked:
+            try:
+                return self._memos[key]
+            except KeyError:
+                memo = self._memos[key] = Memo(self, *key)
+                return memo
+
+    def offload(self, key=None, executor=None):
+        """Mark implementations for out of process execution.
+
+        :param str key:                 The ``module:attrs`` implementation
+                                        name. Defaults to all the
+                                        implementations, including the ones
+                                        plugged in later.
+        :param executor:                See :py:class:`ProcessPlug`.
+        :raises KeyError:               If ``key`` is not plugged in.
+        :raises ValueError:             If ``key`` (or any implementation
+                                        currently plugged in, if ``key`` is
+                                        not given) is not a ``module:attrs``
+                                        reference.
+
+        Each implementation is replaced by a :py:class:`ProcessPlug`, keeping
+        its rating. When ``key`` is not given, implementations plugged in (or
+        set) later are replaced as well, as long as they are named by a
+        ``module:attrs`` reference. To switch them back, see :py:meth:`inline`.
+        """
+        with self.locked:
+            keys = list(self._dict) if key is None else [key]
+            offloaded = dict((k, ProcessPlug(k, self._dict[k], executor))
+                             for k in keys
+                             if not isinstance(self._dict[k], ProcessPlug))
+            self._dict.update(offloaded)
+            if key is None:
+                self._offloaded, self._executor = True, executor
+
+    def inline(self, key=None):
+        """Switch offloaded implementations back to in-process execution.
+
+        :param str key:                 The implementation name. Defaults to
+                                        all the implementations, and stops
+                                        offloading the ones plugged in later.
+        :raises KeyError:               If ``key`` is not plugged in.
+
+        Each :py:class:`ProcessPlug` with a ``local`` implementation is
+        replaced by it, keeping its rating. See :py:meth:`offload`.
+        """
+        with self.locked:
+            keys = list(self._dict) if key is None else [key]
+            inlined = dict((k, self._dict[k].local) for k in keys
+                           if isinstance(self._dict[k], ProcessPlug)
+                           and self._dict[k].local is not None)
+            self._dict.update(inlined)
+            if key is None:
+                self._offloaded, self._executor = False, None
+
+
+_requirements = dict()
+_locked_requirements = Lock()
+_generations = dict()
+
+
+class _Generation(object):
+    "Counts the distributions added to (or replaced in) a working set."
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, distribution):
+        self.count += 1
+
+
+def _generation(working_set):
+    """Returns the state of ``working_set``.
+
+    It changes whenever a distribution is added to the working set, or
+    replaced in it (as per :py:meth:`pkg_resources.WorkingSet.add`).
+    """
+    with _locked_requirements:
+        try:
+            generation = _generations[working_set]
+        except KeyError:
+            generation = _generations[working_set] = _Generation()
+            working_set.subscribe(generation)
+    return generation.count
+
+
+def _require(entry_point):
+    """Resolve the requirements of an entry point distribution.
+
+    :param entry_point:                 A :py:class:`pkg_resources.EntryPoint`.
+
+    Resolving requirements against the working set is the expensive part of
+    :py:meth:`pkg_resources.EntryPoint.load`, and it is the same for all the
+    entry points of a distribution sharing the same extras. So, the outcome is
+    cached and requirements are resolved at most once per working set state
+    (see :py:func:`_generation`).
+    """
+    if entry_point.dist is None:
+        return entry_point.require()
+    key = (entry_point.dist, frozenset(entry_point.extras))
+    state = _generation(_pkg_resources().working_set)
+    with _locked_requirements:
+        if _requirements.get(key) == state:
+            return
+    entry_point.require()
+    # Resolving may add distributions to the working set: the state they are
+    # resolved against is the one after that.
+    state = _generation(_pkg_resources().working_set)
+    with _locked_requirements:
+        _requirements[key] = state
+
+
+def _load_entry(entry_point):
+    "Load ``entry_point`` without resolving its requirements."
+    try:
+        resolve = entry_point.resolve
+    except AttributeError:  # pragma: no cover
+        # setuptools < 11.3
+        return entry_point.load(require=False)
+    return resolve()
+
+
+# Tells missing sockets apart in :py:meth:`Multipla._resolve_`.
+_missing = object()
+
 
 class Multipla(RatedDict):
     """The power strip to put yout plugs into.
@@ -383,16 +1418,50 @@ class Multipla(RatedDict):
     higest rated implementation trough the :py:meth:`Multipla.get` method, but
     you can also use the dictionary item access syntax to reach for all the
     implementations a achieve your goal.
+
+    Before loading an entry point, its distribution requirements are resolved
+    against :py:data:`pkg_resources.working_set` (at most once per working set
+    state). If you trust your environment to be consistent, you can skip the
+    resolution entirely by setting :py:attr:`Multipla.trusted` to ``True``,
+    either on the class or on an instance.
     """
 
+    trusted = False
+
     def __init__(self, name):
         self.name = name
+        self._switching = StripedLock()
+        self._subscriber = functools.partial(Multipla.__call__, self)
+        self._subscribing = threading.RLock()
+        self._subscribed = set()
+        self._bundles = set()
+        self._frozen = set()
         super(Multipla, self).__init__()
 
-    def __call__(self, distribution):   # pragma: no cover
+    def __call__(self, distribution):
         for ep in distribution.get_entry_map(self.name).values():
             implementation = ':'.join([ep.module_name, '.'.join(ep.attrs)])
-            self.switch_on(ep.name).plug_in(implementation, ep.load())
+            if (ep.name, implementation) in self._frozen:
+                # Already loaded from a bundle (see :py:func:`freeze`).
+                continue
+            if not self.trusted:
+                _require(ep)
+            self.switch_on(ep.name).plug_in(implementation, _load_entry(ep))
+
+    def _subscribe_(self, working_set):
+        # Subscribing is serialized per instance, and each working set is
+        # subscribed just once. The lock is reentrant, because loading a
+        # plugin may as well power up its own group: then, the working set
+        # finds the subscriber is already there. A partial is subscribed,
+        # rather than the instance, because :py:mod:`pkg_resources` looks for
+        # duplicated callbacks by equality, and (empty) instances compare
+        # equal as mappings.
+        if working_set in self._subscribed:
+            return
+        with self._subscribing:
+            if working_set not in self._subscribed:
+                working_set.subscribe(self._subscriber)
+                self._subscribed.add(working_set)
 
     def switch_on(self, name):
         """Switch on a socket.
@@ -405,12 +1474,25 @@ class Multipla(RatedDict):
         returned. If there is no :py:class:`MultiPlugAdapter` for the
         specified plugin name, a new one is created and returned.
         """
-        with self.locked:
+        # Looking up an existing socket takes no lock at all. Creation is
+        # serialized per socket name by a lock stripe, so that sockets being
+        # switched on concurrently don't contend, and the container lock is
+        # held just for the insertion.
+        try:
+            return self._dict[name]
+        except KeyError:
+            pass
+        with self._switching[name]:
             try:
-                adapter = self._dict[name]
+                return self._dict[name]
             except KeyError:
-                adapter = self._setitem_(name, MultiPlugAdapter(name))
-        return adapter
+                adapter = MultiPlugAdapter(name)
+                if self.metrics is not None:
+                    adapter.instrument(self.metrics, self._label(name))
+            with self.locked:
+                if name not in self._dict:
+                    self._setitem_(name, adapter)
+                return self._dict[name]
 
     def get(self, name, default=None):
         """Get the higest rated ``plug`` for the given plug ``name``.
@@ -421,25 +1503,580 @@ class Multipla(RatedDict):
         :returns:                       The highest rated plugin.
         :raises KeyError:               If ``name`` lookup fails.
         :raises ValueError:             See :py:data:`RatedDict.highest_rated`.
+
+        If an :py:class:`Overlay` of this instance is active in the current
+        context (see :py:meth:`Overlay.activate`), the lookup goes trough it.
         """
+        overlay = _overlays.get().get(id(self))
+        if overlay is not None:
+            return overlay.get(name, default)
+        return self._get_(name, default)
+
+    def _get_(self, name, default):
         try:
-            return self[name].highest_rated
+            plug = self[name].highest_rated
         except KeyError:
+            if self.metrics is not None:
+                self.metrics.count('get.miss', self._label(name))
             return default
+        if self.metrics is not None:
+            self.metrics.count('get.hit', self._label(name))
+        return plug
+
+    def _label(self, name):
+        return '{}[{}]'.format(self.name, name)
+
+    def _adapter_(self, name):
+        return self._dict.get(name)
+
+    def pipeline(self, *names, **kwargs):
+        """Returns a :py:class:`Pipeline` of the given sockets.
+
+        :param names:                   The socket names, in order. A name can
+                                        also be a ``(name, attribute)`` pair,
+                                        to use an attribute of the
+                                        implementation (e.g. ``encode``).
+        :param int chunksize:           See :py:class:`Pipeline` (keyword
+                                        argument only).
+        :raises KeyError:               If a socket lookup fails.
+        :raises ValueError:             See :py:data:`RatedDict.highest_rated`
+                                        and :py:class:`Pipeline`.
+
+        Implementations are resolved once, trough :py:meth:`get`, when the
+        pipeline is created:
+
+        .. code-block:: python
+
+           codecs = multipla.power_up('codecs')
+           pipeline = codecs.pipeline(('json', 'decode'), 'validate',
+                                      ('msgpack', 'encode'), chunksize=1000)
+           for record in pipeline(stream):
+               ...
+        """
+        chunksize = kwargs.pop('chunksize', None)
+        if kwargs:
+            error = '{}.pipeline: unexpected keyword arguments {}'
+            raise TypeError(error.format(self, sorted(kwargs)))
+        stages = list()
+        for name in names:
+            name, attribute = name if isinstance(name, tuple) else (name, None)
+            plug = self._resolve_(name, 'pipeline')
+            stages.append(plug if attribute is None
+                          else getattr(plug, attribute))
+        return Pipeline(stages, chunksize)
+
+    def _resolve_(self, name, method):
+        plug = self.get(name, _missing)
+        if plug is _missing:
+            error = '{}.{}: unknown socket {}'
+            raise KeyError(error.format(self, method, name))
+        return plug
+
+    def dispatch(self, items, attribute=None):
+        """Call the highest rated implementations over a mixed batch of items.
+
+        :param items:                   An iterable of ``(name, payload)``
+                                        pairs, where ``name`` is a socket
+                                        name.
+        :param str attribute:           If given, the attribute of the
+                                        implementations to call (e.g.
+                                        ``format``).
+        :returns:                       The list of results, in the same order
+                                        of ``items``.
+        :raises KeyError:               If a socket lookup fails.
+        :raises ValueError:             See :py:data:`RatedDict.highest_rated`.
+
+        Each socket is resolved once per batch, and payloads are grouped by
+        implementation. A batch capable implementation (see
+        :py:func:`batch`) is called once per group, with the list of its
+        payloads; any other implementation is called once per payload. So,
+        instead of:
+
+        .. code-block:: python
+
+           [content_types.get(t).format(o) for t, o in items]
+
+        you can write:
+
+        .. code-block:: python
+
+           content_types.dispatch(items, 'format')
+        """
+        calls = dict()
+        groups = collections.OrderedDict()
+        count = 0
+        for index, (name, payload) in enumerate(items):
+            try:
+                plug, call = calls[name]
+            except KeyError:
+                plug = call = self._resolve_(name, 'dispatch')
+                if attribute is not None:
+                    call = getattr(plug, attribute)
+                calls[name] = plug, call
+            group = groups.setdefault(id(plug), (call, list(), list()))
+            group[1].append(index)
+            group[2].append(payload)
+            count = index + 1
+        results = [None] * count
+        for call, indexes, payloads in groups.values():
+            if _is_batch(call):
+                outputs = _call_batch_plug(call, payloads)
+            else:
+                outputs = _call_each(call, payloads)
+            for index, output in zip(indexes, outputs):
+                results[index] = output
+        return results
+
+    def offload(self, name, key=None, executor=None):
+        """Mark the implementations of a socket for out of process execution.
+
+        :param str name:                The socket (entry point) name.
+        :raises KeyError:               If ``name`` lookup fails.
+
+        See :py:meth:`MultiPlugAdapter.offload`.
+        """
+        self[name].offload(key, executor)
+
+    def overlay(self):
+        """Returns a new, empty, :py:class:`Overlay` of this instance."""
+        return Overlay(self)
+
+    def instrument(self, metrics, label=None):
+        """Start (or stop) collecting runtime metrics.
+
+        :param metrics:                 A :py:class:`Metrics` instance, or
+                                        ``None`` to stop collecting.
+        :param str label:               The key used to label the collected
+                                        metrics. Defaults to the group name.
+
+        All the sockets, including the ones switched on later, are
+        instrumented as well, and labeled as ``group[socket]``. The memory
+        footprint of the group is reported by :py:meth:`Metrics.snapshot`.
+        """
+        if label is None:
+            label = self.name
+        with self.locked:
+            super(Multipla, self).instrument(metrics, label)
+            adapters = list(iteritems(self._dict))
+        for name, adapter in adapters:
+            adapter.instrument(metrics, self._label(name))
+        if metrics is not None:
+            metrics.watch(label, self)
+
+
+class AdapterOverlay(collections.Mapping):
+    """A layer of overrides over a :py:class:`MultiPlugAdapter`.
+
+    :param str name:                    The socket (entry point) name.
+    :param parent:                      The :py:class:`Multipla` (or
+                                        :py:class:`Overlay`) the overridden
+                                        socket belongs to.
+
+    Like a :py:class:`collections.ChainMap`, it looks up implementations and
+    ratings in its own layer first, then in the underlying socket, but it's
+    never going to change the underlying socket. It supports the same reading
+    interface of :py:class:`MultiPlugAdapter`, that is ``top``,
+    ``highest_rated`` and ``rating``, and writing trough item setting,
+    ``plug_in`` and ``rate``.
+    """
+    def __init__(self, name, parent):
+        self.name = name
+        self._parent = parent
+        self._dict = collections.OrderedDict()
+        self._ratings = dict()
+        self.locked = Lock()
+
+    def __str__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.name)
+
+    @property
+    def base(self):
+        """The underlying socket, or ``None`` if there is none (yet)."""
+        return self._parent._adapter_(self.name)
+
+    def _rated_(self):
+        base = self.base
+        rated = base._rated_() if base is not None else []
+        with self.locked:
+            if not (self._dict or self._ratings):
+                return rated
+            dict_, ratings = self._dict, self._ratings
+            merged = [(k, ratings.get(k, r), dict_[k] if k in dict_ else v)
+                      for k, r, v in rated]
+            known = set(k for k, r, v in rated)
+            merged.extend((k, ratings.get(k, 0), v)
+                          for k, v in dict_.items() if k not in known)
+        # :py:func:`sorted` is stable, so ties keep the underlying order.
+        return sorted(merged, key=lambda krv: -krv[1])
+
+    def __getitem__(self, key):
+        with self.locked:
+            try:
+                return self._dict[key]
+            except KeyError:
+                pass
+        base = self.base
+        if base is None:
+            raise KeyError(key)
+        return base[key]
+
+    def __iter__(self):
+        return iter([k for k, r, v in self._rated_()])
+
+    def __len__(self):
+        return len(self._rated_())
+
+    def __setitem__(self, key, value):
+        with self.locked:
+            self._dict[key] = value
+
+    def plug_in(self, name, plug):
+        """Try to plug an object in this layer.
+
+        :raises KeyError:               If another object with the same
+                                        ``name`` is already plugged in, in
+                                        any layer.
+        """
+        # The base is read first, as looking into this layer trough
+        # ``__contains__`` takes the (non reentrant) lock.
+        base = self.base
+        with self.locked:
+            try:
+                value = self._dict[name]
+            except KeyError:
+                if base is None or name not in base:
+                    self._dict[name] = plug
+                    return plug
+                value = base[name]
+        error = '{}.plug_in: {} is already set with {}'
+        raise KeyError(error.format(self, name, value))
+
+    def rate(self, ratings=None, **args):
+        """Rate the items in this layer. See :py:meth:`RatedDict.rate`."""
+        ratings = dict(ratings if ratings is not None else (), **args)
+        unexpected = set(ratings) - set(self)
+        if unexpected:
+            error = '{}.rate: unexpected keys {}'
+            raise KeyError(error.format(self, unexpected))
+        with self.locked:
+            self._ratings.update(ratings)
+
+    def top(self, amount=None):
+        """Returns the top rated items. See :py:meth:`RatedDict.top`."""
+        rated = self._rated_()
+        if amount is None:
+            amount = len(rated)
+        if amount > len(rated):
+            error = '{}.top: asked {} items, got {}'
+            raise ValueError(error.format(self, amount, len(rated)))
+        return [(k, v) for k, r, v in rated[:amount]]
+
+    @property
+    def highest_rated(self):
+        """The value of the highest rated item, in any layer.
+
+        :raises ValueError:             If all layers are empty.
+        """
+        rated = self._rated_()
+        if not rated:
+            error = '{}.highest_rated: empty container'
+            raise ValueError(error.format(self))
+        return rated[0][2]
+
+    def rating(self, key):
+        """Returns the rating of ``key``, in any layer.
+
+        :raises KeyError:               If ``key`` does not exists.
+        """
+        for k, r, v in self._rated_():
+            if k == key:
+                return r
+        raise KeyError(key)
+
+
+_overlays = _context_var('multipla.overlays', dict())
+
+
+class Overlay(collections.Mapping):
+    """A layer of per-context overrides over a :py:class:`Multipla`.
+
+    :param parent:                      The :py:class:`Multipla` (or the
+                                        :py:class:`Overlay`) to override.
+
+    Overlays are meant for per-request or per-tenant overrides, like different
+    ratings or extra implementations, that must not affect the shared
+    :py:class:`Multipla`. Creating an overlay costs the same whatever the size
+    of the :py:class:`Multipla`: sockets are layered on demand, as
+    :py:class:`AdapterOverlay` instances, by :py:meth:`switch_on` and by item
+    lookups (so writing to ``overlay[name]`` never changes the parent), while
+    :py:meth:`get` of not overridden sockets goes straight to the parent.
+
+    .. code-block:: python
+
+       tenant = plugin_group.overlay()
+       socket = tenant.switch_on('socket')
+       socket.plug_in('tenant:implementation', implementation)
+       socket.rate({'tenant:implementation': 10})
+       with tenant.activate():
+           assert plugin_group.get('socket') is implementation
+    """
+    def __init__(self, parent):
+        self.name = parent.name
+        self.parent = parent
+        self.root = parent.root if isinstance(parent, Overlay) else parent
+        self._sockets = dict()
+        self.locked = Lock()
+
+    def __str__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.name)
+
+    def __getitem__(self, name):
+        adapter = self._adapter_(name)
+        if adapter is None:
+            raise KeyError(name)
+        return adapter
+
+    def _names_(self):
+        names = list(self.parent)
+        known = set(names)
+        names.extend(n for n in list(self._sockets) if n not in known)
+        return names
+
+    def __iter__(self):
+        return iter(self._names_())
+
+    def __len__(self):
+        return len(self._names_())
+
+    def _adapter_(self, name):
+        adapter = self._sockets.get(name)
+        if adapter is None and self.parent._adapter_(name) is not None:
+            adapter = self.switch_on(name)
+        return adapter
+
+    def switch_on(self, name):
+        """Returns the :py:class:`AdapterOverlay` of the socket ``name``.
+
+        It's created on first call, even if the socket doesn't exist in the
+        parent yet.
+        """
+        with self.locked:
+            try:
+                return self._sockets[name]
+            except KeyError:
+                adapter = AdapterOverlay(name, self.parent)
+                return self._sockets.setdefault(name, adapter)
+
+    def get(self, name, default=None):
+        """Get the highest rated ``plug`` for the given plug ``name``.
+
+        See :py:meth:`Multipla.get`.
+        """
+        return self._get_(name, default)
+
+    def _get_(self, name, default):
+        adapter = self._sockets.get(name)
+        if adapter is not None:
+            rated = adapter._rated_()
+            if rated:
+                return rated[0][2]
+        # Not overridden, or switched on but still empty.
+        return self.parent._get_(name, default)
+
+    def overlay(self):
+        """Returns a new, empty, :py:class:`Overlay` of this overlay."""
+        return Overlay(self)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make :py:meth:`Multipla.get` go trough this overlay.
+
+        It's a context manager: the overlay is active within the ``with``
+        block, in the current :py:mod:`contextvars` context (or in the current
+        thread, if :py:mod:`contextvars` is not available), so concurrent
+        requests and tasks can activate different overlays of the same
+        :py:class:`Multipla`.
+        """
+        active = dict(_overlays.get())
+        active[id(self.root)] = self
+        token = _overlays.set(active)
+        try:
+            yield self
+        finally:
+            _overlays.reset(token)
 
 
 _register = dict()
-_locked_register = Lock()
+_locked_register = StripedLock()
+
+
+_MANIFEST = 'multipla.json'
+
+
+def _source(filename):
+    "Returns the source file name of a module file name."
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    return filename
+
 
+def _package_files(directory, package):
+    """Returns the ``(archive name, path)`` of the files of a package.
 
-def power_up(name, *args):
+    A package containing extension modules can't be imported from a zip
+    archive, so an empty list is returned.
+    """
+    files = list()
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for name in names:
+            if name.endswith(('.so', '.pyd')):
+                return []
+            if not name.endswith(('.pyc', '.pyo')):
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, directory).split(os.sep)
+                files.append(('/'.join([package] + relative), path))
+    return files
+
+
+def _magic():
+    "Returns the bytecode magic number of the running interpreter, as text."
+    return binascii.hexlify(_MAGIC_NUMBER).decode('ascii')
+
+
+def _is_stdlib(path):
+    "Tells whether ``path`` belongs to the standard library."
+    paths = sysconfig.get_paths()
+    path = os.path.realpath(path)
+
+    def within(key):
+        directory = os.path.realpath(paths.get(key) or os.devnull)
+        return path.startswith(directory + os.sep)
+
+    # Site packages may as well be within the standard library directory.
+    return ((within('stdlib') or within('platstdlib'))
+            and not (within('purelib') or within('platlib')))
+
+
+def _bundle_files(module_names):
+    """Returns the ``(archive name, path)`` of the files to bundle.
+
+    Modules are bundled along with their whole top level package, otherwise
+    their siblings could not be imported anymore. Standard library modules
+    are left out, otherwise the bundle would shadow them.
+    """
+    files = list()
+    for top in sorted(set(name.partition('.')[0] for name in module_names)):
+        module = importlib.import_module(top)
+        source = _source(getattr(module, '__file__', None) or '')
+        if not source or _is_stdlib(source):
+            continue
+        if os.path.basename(source) == '__init__.py':
+            files.extend(_package_files(os.path.dirname(source), top))
+        elif source.endswith('.py'):
+            files.append((top + '.py', source))
+    return files
+
+
+def _compile(path, dfile):
+    "Returns the bytecode (``.pyc`` file content) of a source file."
+    handle, compiled = tempfile.mkstemp(suffix='.pyc')
+    os.close(handle)
+    try:
+        py_compile.compile(path, cfile=compiled, dfile=dfile, doraise=True)
+        with open(compiled, 'rb') as bytecode:
+            return bytecode.read()
+    finally:
+        os.remove(compiled)
+
+
+def freeze(path, *groups):
+    """Write a frozen plugin bundle.
+
+    :param str path:                    The bundle (zip archive) path.
+    :param groups:                      The names of the entry point groups to
+                                        freeze.
+    :returns:                           The manifest: a :py:class:`dict`
+                                        holding the bytecode ``magic`` number
+                                        and the ``groups``, mapping each group
+                                        to a list of ``[socket, rating,
+                                        implementations]``, where
+                                        ``implementations`` is a list of
+                                        ``[implementation, rating]``.
+
+    Each group is powered up and its current sockets, implementations and
+    ratings are recorded in the manifest. Then the modules referenced by the
+    implementations (i.e. their top level packages) are compiled and written
+    to the bundle, so that :py:func:`power_up` can later load them trough
+    :py:mod:`zipimport` instead of discovering them. Implementations that are
+    not ``module:attrs`` references (e.g. plugged in at runtime) are left out,
+    as well as the standard library and packages with extension modules,
+    which are imported as usual. The bundle can only be loaded by interpreters
+    sharing the same bytecode magic number. You would run it as a build step,
+    like::
+
+        python -c "import multipla; multipla.freeze('plugins.zip', 'group')"
+    """
+    manifest = dict(magic=_magic(), groups=dict())
+    module_names = set()
+    for group in groups:
+        sockets = manifest['groups'][group] = list()
+        for socket, rating, adapter in power_up(group)._rated_():
+            implementations = [[key, r] for key, r, plug in adapter._rated_()
+                               if ':' in key]
+            sockets.append([socket, rating, implementations])
+            module_names.update(key.partition(':')[0]
+                                for key, r in implementations)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name, source in _bundle_files(module_names):
+            if name.endswith('.py'):
+                dfile = os.path.join(path, name)
+                bundle.writestr(name + 'c', _compile(source, dfile))
+            else:
+                bundle.write(source, name)
+        bundle.writestr(_MANIFEST, json.dumps(manifest, indent=1))
+    return manifest
+
+
+def _load(multipla, bundle):
+    "Plug the implementations frozen in ``bundle`` into ``multipla``."
+    with zipfile.ZipFile(bundle) as archive:
+        manifest = json.loads(archive.read(_MANIFEST).decode('utf-8'))
+    if manifest.get('magic') != _magic():
+        error = 'power_up: {} was frozen by another Python version'
+        raise ValueError(error.format(bundle))
+    try:
+        sockets = manifest['groups'][multipla.name]
+    except KeyError:
+        error = 'power_up: {} not frozen in {}'
+        raise KeyError(error.format(multipla.name, bundle))
+    if bundle not in sys.path:
+        sys.path.insert(0, bundle)
+    for socket, rating, implementations in sockets:
+        adapter = multipla.switch_on(socket)
+        for implementation, r in implementations:
+            if implementation not in adapter:
+                adapter.plug_in(implementation, _resolve(implementation))
+            multipla._frozen.add((socket, implementation))
+        adapter.rate(implementations)
+    multipla.rate((socket, rating) for socket, rating, i in sockets)
+
+
+def power_up(name, *args, **kwargs):
     """Creates and returns a rated dictionary of plugins.
 
     :param str name:                    The multi-plug name (i.e. entry point
                                         group).
     :param args:                        Variable argument list of
                                         :py:class:`pkg_resources.WorkingSet`.
+    :param str bundle:                  The path of a bundle written by
+                                        :py:func:`freeze` (keyword argument
+                                        only).
     :rtype:                             :py:class:`Multipla`
+    :raises KeyError:                   If ``name`` is not frozen in
+                                        ``bundle``.
+    :raises ValueError:                 If ``bundle`` was frozen by a Python
+                                        version with a different bytecode.
 
     I meant to have just one :py:class:`Multipla` instances for each group of
     entry points. They are powered up by subscribing (as per
@@ -464,14 +2101,32 @@ def power_up(name, *args):
     True
     >>> isinstance(plugin_group, multipla.Multipla)
     True
+
+    If a ``bundle`` is provided instead, plugins are loaded from it (just the
+    first time) and no working set is subscribed, unless explicitly provided.
+    Working sets subscribed later (or before) don't load again the
+    implementations found in the bundle.
     """
-    with _locked_register:
-        try:
-            multipla = _register[name]
-        except KeyError:
-            _register[name] = multipla = Multipla(name)
-    if not args:
-        args = [pkg_resources.working_set]
+    bundle = kwargs.pop('bundle', None)
+    if kwargs:
+        error = 'power_up: unexpected keyword arguments {}'
+        raise TypeError(error.format(sorted(kwargs)))
+    try:
+        multipla = _register[name]
+    except KeyError:
+        with _locked_register[name]:
+            try:
+                multipla = _register[name]
+            except KeyError:
+                _register[name] = multipla = Multipla(name)
+    if bundle is not None:
+        # Reentrant, as frozen plugins may power up groups as well.
+        with multipla._subscribing:
+            if bundle not in multipla._bundles:
+                _load(multipla, bundle)
+                multipla._bundles.add(bundle)
+    elif not args:
+        args = [_pkg_resources().working_set]
     for working_set in args:
-        working_set.subscribe(multipla)
+        multipla._subscribe_(working_set)
     return multipla
@@ -0,0 +1,127 @@
+"""
+Stress harness for the concurrent paths of :py:mod:`multipla`.
+
+It hammers :py:func:`multipla.power_up` and
+:py:meth:`multipla.Multipla.switch_on` from many threads, against a working set
+of distributions providing entry points for all the groups. It checks that each
+group and each socket is created just once, and populated just once, and
+reports the throughput (and the speedup over a single thread) for an
+increasing number of threads::
+
+    python stress_multipla.py [max threads] [operations per thread]
+"""
+import sys
+import threading
+
+import multipla
+
+import pkg_resources
+
+GROUPS = 16
+SOCKETS = 64
+DISTRIBUTIONS = 8
+
+
+def working_set(distributions=DISTRIBUTIONS):
+    """Returns a :py:class:`pkg_resources.WorkingSet` of ``distributions``.
+
+    Each distribution provides an entry point for every group, for the sockets
+    it is in charge of (so each socket is provided by a single distribution).
+    """
+    working_set = pkg_resources.WorkingSet([])
+    for index in range(distributions):
+        dist = pkg_resources.Distribution(
+            location='stress-{}'.format(index),
+            project_name='stress-{}'.format(index), version='1.0')
+        dist._ep_map = dict(
+            ('stress.{}'.format(group), dict(
+                ('socket.{}'.format(socket), pkg_resources.EntryPoint.parse(
+                    'socket.{} = os:getcwd'.format(socket), dist=dist))
+                for socket in range(index, SOCKETS, distributions)))
+            for group in range(GROUPS))
+        working_set.add(dist)
+    return working_set
+
+
+def hammer(working_set, threads, operations):
+    """Run ``operations`` power ups and switch ons in each of ``threads``.
+
+    :returns:                           A ``(seconds, seen)`` pair, where
+                                        ``seen`` maps each ``(group, socket)``
+                                        (``socket`` is ``None`` for the group
+                                        itself) to the set of distinct
+                                        instances ids seen.
+    :raises RuntimeError:               If any thread failed.
+    """
+    seen = dict()
+    errors = list()
+    locked = threading.Lock()
+    start = threading.Event()
+
+    def worker(offset):
+        local = dict()
+        start.wait()
+        try:
+            for operation in range(operations):
+                counter = offset + operation
+                group = 'stress.{}'.format(counter % GROUPS)
+                plugs = multipla.power_up(group, working_set)
+                socket = plugs.switch_on('socket.{}'.format(counter % SOCKETS))
+                local.setdefault((group, socket.name), set()).add(id(socket))
+                local.setdefault((group, None), set()).add(id(plugs))
+        except Exception as error:
+            with locked:
+                errors.append(error)
+        with locked:
+            for key, ids in local.items():
+                seen.setdefault(key, set()).update(ids)
+
+    workers = [threading.Thread(target=worker, args=(index * operations,))
+               for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    started = multipla._timer()
+    start.set()
+    for thread in workers:
+        thread.join()
+    seconds = multipla._timer() - started
+    if errors:
+        raise RuntimeError('{} threads failed: {}'.format(len(errors), errors))
+    return seconds, seen
+
+
+def check(seen):
+    "Returns the keys that have been bound to more than one instance."
+    return sorted(key for key, ids in seen.items() if len(ids) > 1)
+
+
+def unpopulated():
+    "Returns the sockets that do not hold a single implementation."
+    return sorted((group, name)
+                  for group in ('stress.{}'.format(g) for g in range(GROUPS))
+                  for name, adapter in multipla._register[group].items()
+                  if len(adapter) != 1)
+
+
+def main(max_threads=32, operations=10000):
+    threads = 1
+    single = None
+    while threads <= max_threads:
+        # A fresh set of groups, and of distributions, for each round, to
+        # hammer the creation and the subscription paths.
+        multipla._register.clear()
+        seconds, seen = hammer(working_set(), threads, operations)
+        failures = check(seen) + unpopulated()
+        rate = threads * operations / seconds
+        single = single or rate
+        print('{:>4} threads: {:>12.0f} ops/s {:>6.2f}x{}'.format(
+            threads, rate, rate / single, ' FAILURES {}'.format(failures)
+            if failures else ''))
+        if failures:
+            return 1
+        threads *= 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -1,6 +1,13 @@
+import json
+import operator
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import types
 import unittest
+import zipfile
 
 import multipla
 
@@ -33,6 +40,67 @@ class Testlock(unittest.TestCase):
             self.assertTrue(self.locked)
         self.assertFalse(self.locked)
 
+    def test_striped(self):
+        striped = multipla.StripedLock(4)
+        self.assertEqual(len(striped), 4)
+        self.assertIs(striped['test'], striped['test'])
+        self.assertIsInstance(striped['test'], multipla.Lock)
+
+    def test_metrics(self):
+        self.locked.metrics = metrics = multipla.Metrics()
+        self.locked.name = 'test'
+        with self.locked:
+            pass
+        histograms = metrics.snapshot()['histograms']
+        self.assertEqual(histograms['lock.wait']['test']['count'], 1)
+        self.assertEqual(histograms['lock.hold']['test']['count'], 1)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.events = list()
+        self.metrics = multipla.Metrics(
+            lambda *event: self.events.append(event))
+
+    def test_count(self):
+        self.metrics.count('test', 'a')
+        self.metrics.count('test', 'a', 2)
+        self.metrics.count('test')
+        self.assertEqual(self.metrics.snapshot()['counters'],
+                         {'test': {'a': 3, None: 1}})
+        self.assertEqual(self.events, [('test', 'a', 1), ('test', 'a', 2),
+                                       ('test', None, 1)])
+
+    def test_observe(self):
+        for value in (0.5e-6, 0.5, 5):
+            self.metrics.observe('test', value)
+        histogram = self.metrics.snapshot()['histograms']['test'][None]
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['max'], 5)
+        self.assertEqual(histogram['buckets'], [1, 0, 0, 0, 0, 0, 1, 1])
+        self.assertEqual(len(self.events), 3)
+
+    def test_reentrant_callback(self):
+        snapshots = list()
+        metrics = multipla.Metrics(
+            lambda *event: snapshots.append(metrics.snapshot()))
+        mp = multipla.Multipla('test')
+        mp.instrument(metrics)
+        mp.switch_on('test')
+        self.assertTrue(snapshots)
+        self.assertIn('test', snapshots[-1]['memory'])
+        histograms = metrics.snapshot()['histograms']
+        self.assertIn('test', histograms['lock.hold'])
+
+    def test_watch(self):
+        rd = multipla.RatedDict()
+        self.metrics.watch('test', rd)
+        self.assertEqual(self.metrics.snapshot()['memory'],
+                         {'test': rd.footprint()})
+        del rd
+        self.assertEqual(self.metrics.snapshot()['memory'], {})
+
 
 RatedMappingView = (multipla.collections.MappingView, multipla.collections.Set)
 
@@ -136,6 +204,21 @@ class TestRatedDict(unittest.TestCase):
         self.rd.rate(test=1)
         self.assertEqual(self.rd.rating('test'), 1)
 
+    def test_instrument(self):
+        metrics = multipla.Metrics()
+        self.rd.instrument(metrics)
+        self.assertIs(self.rd.metrics, metrics)
+        self.assertIs(self.rd.locked.metrics, metrics)
+        self.assertEqual(self.rd.locked.name, str(self.rd))
+        self.rd.instrument(None, 'test')
+        self.assertIsNone(self.rd.locked.metrics)
+        self.assertEqual(self.rd.locked.name, 'test')
+
+    def test_footprint(self):
+        empty = self.rd.footprint()
+        self.rd['test'] = multipla.RatedDict()
+        self.assertGreater(self.rd.footprint(), empty)
+
         
     @genty.genty_dataset(**test_iterview_dataset)
     def test_iterviews(self, name, consumer, returns):
@@ -161,6 +244,401 @@ class TestMultiPlugAdapter(unittest.TestCase):
             self.mpa.plug_in('test', 10)
 
 
+class TestProcessPlug(unittest.TestCase):
+
+    def setUp(self):
+        super(TestProcessPlug, self).setUp()
+        self.executor = multipla.futures.ThreadPoolExecutor(2)
+        self.plug = multipla.ProcessPlug('operator:add', executor=self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_reference(self):
+        with self.assertRaises(ValueError):
+            multipla.ProcessPlug('operator.add')
+        self.assertEqual(repr(self.plug), "<ProcessPlug 'operator:add'>")
+        self.assertIs(multipla._resolve('os:path.join'), os.path.join)
+        self.assertIs(multipla._resolve('os:'), os)
+        with self.assertRaises(ValueError):
+            multipla._resolve('os')
+
+    def test_calls(self):
+        self.assertEqual(self.plug(1, 2), 3)
+        self.assertEqual(self.plug.submit(2, 3).result(), 5)
+        batch = self.plug.submit_batch([((1, 1), {}), ([2, 2], {})])
+        self.assertEqual(batch.result(), [2, 4])
+        results = self.plug.map(range(5), range(5), chunksize=2)
+        self.assertEqual(list(results), [0, 2, 4, 6, 8])
+        with self.assertRaises(TypeError):
+            self.plug.map(range(5), unexpected=True)
+
+    def test_process_pool(self):
+        plug = multipla.ProcessPlug('operator:neg')
+        self.assertIs(plug.executor, multipla.process_pool())
+        try:
+            self.assertEqual(list(plug.map(range(4), chunksize=2)),
+                             [0, -1, -2, -3])
+        finally:
+            multipla.shutdown_process_pool()
+        self.assertNotIn('ProcessPoolExecutor', multipla._pools)
+        multipla.shutdown_process_pool()
+
+    def test_offload(self):
+        mpa = multipla.MultiPlugAdapter('test')
+        mpa.plug_in('operator:add', operator.add)
+        mpa.plug_in('operator:mul', operator.mul)
+        mpa.plug_in('invalid', None)
+        mpa.rate({'operator:mul': 1})
+        with self.assertRaises(ValueError):
+            mpa.offload()
+        self.assertIs(mpa['operator:add'], operator.add)
+        mpa.offload('operator:mul', self.executor)
+        offloaded = mpa.highest_rated
+        self.assertIsInstance(offloaded, multipla.ProcessPlug)
+        self.assertIs(offloaded.local, operator.mul)
+        self.assertEqual(offloaded(2, 3), 6)
+        mpa.offload('operator:mul')
+        self.assertIs(mpa['operator:mul'], offloaded)
+        mp = multipla.Multipla('test')
+        mp.switch_on('test').plug_in('operator:add', operator.add)
+        mp.offload('test', executor=self.executor)
+        self.assertEqual(mp.get('test')(1, 2), 3)
+
+    def test_offload_later(self):
+        mpa = multipla.MultiPlugAdapter('test')
+        mpa.plug_in('operator:add', operator.add)
+        mpa.offload(executor=self.executor)
+        offloaded = mpa.plug_in('operator:mul', operator.mul)
+        self.assertIsInstance(offloaded, multipla.ProcessPlug)
+        self.assertIs(mpa['operator:mul'], offloaded)
+        self.assertIs(offloaded.local, operator.mul)
+        self.assertEqual(offloaded(2, 3), 6)
+        mpa['operator:sub'] = operator.sub
+        self.assertIsInstance(mpa['operator:sub'], multipla.ProcessPlug)
+        mpa.plug_in('local', len)
+        self.assertIs(mpa['local'], len)
+        mpa.inline('operator:add')
+        self.assertIs(mpa['operator:add'], operator.add)
+        self.assertIsInstance(mpa['operator:mul'], multipla.ProcessPlug)
+        mpa.inline()
+        self.assertIs(mpa['operator:mul'], operator.mul)
+        mpa.plug_in('operator:neg', operator.neg)
+        self.assertIs(mpa['operator:neg'], operator.neg)
+
+
+def failing(*args):
+    raise RuntimeError(args)
+
+
+class TestHedge(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHedge, self).setUp()
+        self.released = threading.Event()
+        self.executor = multipla.futures.ThreadPoolExecutor(4)
+        self.mpa = multipla.MultiPlugAdapter('test')
+        self.mpa.update(fast=abs, failing=failing, slow=self.slow)
+
+    def tearDown(self):
+        self.released.set()
+        self.executor.shutdown()
+
+    def slow(self, value):
+        self.released.wait()
+        return 'slow'
+
+    def hedge(self, first, second, **kwargs):
+        self.mpa.rate(dict.fromkeys(self.mpa, 0), **{first: 2, second: 1})
+        return self.mpa.hedged(executor=self.executor, delay=0.01, **kwargs)
+
+    def test_call(self):
+        hedge = self.hedge('fast', 'slow')
+        self.assertEqual(hedge(-1), 1)
+        self.assertEqual(hedge.stats(), {
+            'calls': 1, 'hedged': 0, 'hedges': 0, 'failovers': 0,
+            'failures': 0, 'wins': {'fast': 1}})
+
+    def test_hedge(self):
+        hedge = self.hedge('slow', 'fast')
+        self.assertEqual(hedge(-1), 1)
+        stats = hedge.stats()
+        self.assertEqual((stats['hedged'], stats['hedges']), (1, 1))
+        self.assertEqual(stats['wins'], {'fast': 1})
+
+    def test_failover(self):
+        hedge = self.hedge('failing', 'fast')
+        hedge.delay = 10
+        self.assertEqual(hedge(-1), 1)
+        self.assertEqual(hedge.stats()['failovers'], 1)
+        self.assertEqual(hedge.stats()['hedges'], 0)
+        hedge = self.hedge('failing', 'slow', amount=1)
+        with self.assertRaises(RuntimeError):
+            hedge(-1)
+        self.assertEqual(hedge.stats()['failures'], 1)
+
+    def late_hedge(self):
+        """Returns a hedge whose first implementation fails only once the
+        second one (a hedge) is running."""
+        started = threading.Event()
+
+        def hedging(value):
+            started.set()
+            return self.slow(value)
+
+        def late_failing(value):
+            started.wait()
+            raise RuntimeError(value)
+
+        self.mpa.update(hedging=hedging, late_failing=late_failing)
+        self.mpa.rate(dict.fromkeys(self.mpa, 0),
+                      late_failing=3, hedging=2, fast=1)
+        return self.mpa.hedged(executor=self.executor, delay=0.01, amount=3)
+
+    def test_failover_while_hedging(self):
+        # The third implementation replaces the failed one right away.
+        hedge = self.late_hedge()
+        self.assertEqual(hedge(-1), 1)
+        stats = hedge.stats()
+        self.assertEqual((stats['hedges'], stats['failovers']), (1, 1))
+        self.assertEqual(stats['wins'], {'fast': 1})
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            multipla.MultiPlugAdapter('empty').hedged()(1)
+
+    def test_percentile(self):
+        hedge = self.hedge('fast', 'slow', percentile=50)
+        self.assertIs(hedge.executor, self.executor)
+        self.assertEqual(hedge._delay_(), 0.01)
+        for latency in range(hedge.warmup + 1):
+            hedge._observe_(latency)
+        self.assertEqual(hedge._delay_(), hedge.warmup // 2)
+
+    def test_primary_latency(self):
+        hedge = self.hedge('slow', 'fast', percentile=50)
+        self.assertEqual(hedge(-1), 1)
+        self.assertFalse(hedge._latencies)
+        self.released.set()
+        self.executor.shutdown()
+        latencies = list(hedge._latencies)
+        self.assertEqual(len(latencies), 1)
+        self.assertGreaterEqual(latencies[0], hedge.delay)
+
+    def acall(self, loop, hedge, *args):
+        "Call ``hedge.acall`` from ``loop``, and wait for the result."
+        asyncio = multipla.importlib.import_module('asyncio')
+        called = list()
+        loop.call_soon(lambda: called.append(hedge.acall(*args)))
+        loop.run_until_complete(asyncio.sleep(0))
+        return loop.run_until_complete(called[0])
+
+    @unittest.skipIf(multipla.PY2, 'asyncio is not available')
+    def test_acall(self):
+        asyncio = multipla.importlib.import_module('asyncio')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        hedged = self.hedge('slow', 'fast')
+        self.assertEqual(self.acall(loop, hedged, -1), 1)
+        self.assertEqual(hedged.stats()['hedges'], 1)
+        hedge = self.late_hedge()
+        self.assertEqual(self.acall(loop, hedge, -1), 1)
+        stats = hedge.stats()
+        self.assertEqual((stats['hedges'], stats['failovers']), (1, 1))
+        self.released.set()
+        hedge = self.hedge('failing', 'fast')
+        self.assertEqual(self.acall(loop, hedge, -1), 1)
+        self.assertEqual(hedge.stats()['failovers'], 1)
+        hedge = self.hedge('failing', 'slow', amount=1)
+        with self.assertRaises(RuntimeError):
+            self.acall(loop, hedge, -1)
+        self.assertEqual(hedge.stats()['failures'], 1)
+        if hasattr(asyncio, 'get_running_loop'):
+            with self.assertRaises(RuntimeError):
+                hedge.acall(-1)
+
+        self.executor.shutdown()
+        self.assertEqual(len(hedged._latencies), 1)
+        self.assertGreaterEqual(hedged._latencies[0], hedged.delay)
+
+
+class TestMemo(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMemo, self).setUp()
+        self.calls = list()
+        self.mpa = multipla.MultiPlugAdapter('test')
+        self.mpa.update(upper=self.upper, lower=self.lower)
+        self.mpa.rate(upper=1)
+
+    def upper(self, value, suffix=''):
+        self.calls.append(value)
+        return value.upper() + suffix
+
+    def lower(self, value):
+        self.calls.append(value)
+        return value.lower()
+
+    def test_call(self):
+        memo = self.mpa.memoized()
+        self.assertEqual(memo('a'), 'A')
+        self.assertEqual(memo('a'), 'A')
+        self.assertEqual(memo('a', suffix='!'), 'A!')
+        self.assertEqual(memo('a', suffix='!'), 'A!')
+        self.assertEqual(self.calls, ['a', 'a'])
+        stats = memo.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertNotIn('bytes', stats)
+        memo.clear()
+        self.assertEqual(memo.stats()['size'], 0)
+        self.assertEqual(multipla.Memo(self.mpa).stats()['hit_rate'], 0)
+
+    def test_typed(self):
+        mpa = multipla.MultiPlugAdapter('test')
+        mpa.plug_in('repr', repr)
+        memo = mpa.memoized()
+        self.assertEqual([memo(1), memo(True), memo(1.0)], ['1', 'True', '1.0'])
+        self.assertEqual(memo.stats()['misses'], 3)
+        self.assertEqual(memo(1), '1')
+        self.assertEqual(memo.stats()['hits'], 1)
+
+    def test_shared(self):
+        memo = self.mpa.memoized()
+        self.assertIs(self.mpa.memoized(), memo)
+        self.assertIs(self.mpa.memoized(128), memo)
+        self.assertIsNot(self.mpa.memoized(maxsize=2), memo)
+        memo('a')
+        self.assertEqual(self.mpa.memoized()('a'), 'A')
+        self.assertEqual(self.calls, ['a'])
+
+    def test_invalidation(self):
+        memo = self.mpa.memoized()
+        self.assertEqual(memo('A'), 'A')
+        self.mpa.rate(lower=2)
+        self.assertEqual(memo('A'), 'a')
+        self.assertEqual(memo('A'), 'a')
+        self.assertEqual(self.calls, ['A', 'A'])
+        self.assertEqual(memo.stats()['invalidations'], 1)
+        self.mpa.plug_in('title', str.title)
+        self.mpa.rate(title=3)
+        self.assertEqual(memo('A'), 'A')
+        self.assertEqual(memo.stats()['invalidations'], 2)
+
+    def test_eviction(self):
+        memo = self.mpa.memoized(maxsize=2)
+        for value in 'abca':
+            memo(value)
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'a'])
+        self.assertEqual(memo.stats()['evictions'], 2)
+        memo = self.mpa.memoized(maxbytes=multipla._sizeof('A') * 2)
+        for value in 'abbc':
+            memo(value)
+        stats = memo.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (2, 1))
+        self.assertEqual(stats['bytes'], multipla._sizeof('A') * 2)
+
+    def test_maxsize(self):
+        memo = self.mpa.memoized(maxsize=None)
+        for value in 'abcdef':
+            memo(value)
+        self.assertEqual(memo.stats()['size'], 6)
+        self.assertEqual(memo.stats()['evictions'], 0)
+        for maxsize in (0, -1):
+            with self.assertRaises(ValueError):
+                self.mpa.memoized(maxsize=maxsize)
+
+    def test_attribute(self):
+        mpa = multipla.MultiPlugAdapter('test')
+        mpa.plug_in('str', str)
+        memo = mpa.memoized(attribute='upper')
+        self.assertEqual(memo('a'), 'A')
+
+
+@multipla.batch
+def doubled(items):
+    doubled.calls.append(list(items))
+    return [item * 2 for item in items]
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPipeline, self).setUp()
+        doubled.calls = list()
+
+    def test_batch(self):
+        self.assertTrue(multipla._is_batch(doubled))
+        self.assertFalse(multipla._is_batch(abs))
+
+    def test_items(self):
+        pipeline = multipla.Pipeline([abs, doubled, str])
+        self.assertEqual(list(pipeline(range(-2, 1))), ['4', '2', '0'])
+        self.assertEqual(doubled.calls, [[2], [1], [0]])
+
+    def test_chunks(self):
+        pipeline = multipla.Pipeline([abs, doubled, str], chunksize=2)
+        results = pipeline(iter(range(-2, 1)))
+        self.assertEqual(next(results), '4')
+        self.assertEqual(doubled.calls, [[2, 1]])
+        self.assertEqual(list(results), ['2', '0'])
+        self.assertEqual(doubled.calls, [[2, 1], [0]])
+        for chunksize in (0, -1):
+            with self.assertRaises(ValueError):
+                multipla.Pipeline([abs], chunksize=chunksize)
+
+    def test_wrong_batch(self):
+        pipeline = multipla.Pipeline([multipla.batch(lambda items: [])])
+        with self.assertRaises(ValueError):
+            list(pipeline(range(2)))
+
+    def test_multipla(self):
+        mp = multipla.Multipla('test')
+        mp.switch_on('abs').plug_in('abs', abs)
+        mp.switch_on('text').plug_in('padded', '{:03d}')
+        pipeline = mp.pipeline('abs', ('text', 'format'), chunksize=10)
+        self.assertEqual(list(pipeline([-1, 2])), ['001', '002'])
+        self.assertEqual(pipeline.chunksize, 10)
+        with self.assertRaises(KeyError):
+            mp.pipeline('abs', 'missing')
+        with self.assertRaises(TypeError):
+            mp.pipeline('abs', unexpected=True)
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDispatch, self).setUp()
+        doubled.calls = list()
+        self.mp = multipla.Multipla('test')
+        self.mp.switch_on('abs').plug_in('abs', abs)
+        self.mp.switch_on('doubled').plug_in('doubled', doubled)
+        self.mp.switch_on('also doubled').plug_in('doubled', doubled)
+
+    def test_dispatch(self):
+        items = [('abs', -1), ('doubled', 2), ('abs', -3),
+                 ('also doubled', 4), ('doubled', 5)]
+        self.assertEqual(self.mp.dispatch(iter(items)), [1, 4, 3, 8, 10])
+        self.assertEqual(doubled.calls, [[2, 4, 5]])
+        self.assertEqual(self.mp.dispatch([]), [])
+        with self.assertRaises(KeyError):
+            self.mp.dispatch([('abs', 1), ('missing', 1)])
+
+    def test_attribute(self):
+        self.mp.switch_on('text').plug_in('padded', '{:03d}')
+        self.assertEqual(self.mp.dispatch([('text', 1), ('text', 2)],
+                                          'format'), ['001', '002'])
+
+    def test_bench(self):
+        # Imported here, so that the benchmark can't break the collection.
+        bench = multipla.importlib.import_module('bench_multipla')
+        timings = bench.bench(30, 1)
+        self.assertEqual(sorted(timings),
+                         ['dispatch', 'dispatch batch', 'loop'])
+
+
 class TestMultipla(unittest.TestCase):
 
     def setUp(self):
@@ -181,14 +659,375 @@ class TestMultipla(unittest.TestCase):
         test.rate({'first': 1, 'second': 3})
         self.assertEqual(self.mp.get('test'), 2)
 
+    def test_instrument(self):
+        before = self.mp.switch_on('before')
+        metrics = multipla.Metrics()
+        self.mp.instrument(metrics)
+        after = self.mp.switch_on('after')
+        self.assertEqual(before.locked.name, 'test[before]')
+        self.assertEqual(after.locked.name, 'test[after]')
+        after.plug_in('first', 1)
+        self.mp.get('after')
+        self.mp.get('missing')
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'],
+                         {'get.hit': {'test[after]': 1},
+                          'get.miss': {'test[missing]': 1}})
+        self.assertIn('test[after]', snapshot['histograms']['lock.hold'])
+        self.assertEqual(list(snapshot['memory']), ['test'])
+
+
+class TestOverlay(unittest.TestCase):
+
+    def setUp(self):
+        super(TestOverlay, self).setUp()
+        self.mp = multipla.Multipla('test')
+        shared = self.mp.switch_on('shared')
+        shared.update(first=1, second=2)
+        shared.rate(first=2, second=1)
+        self.mp.switch_on('other').plug_in('only', 3)
+        self.overlay = self.mp.overlay()
+
+    def test_get(self):
+        socket = self.overlay.switch_on('shared')
+        self.assertIs(socket, self.overlay.switch_on('shared'))
+        self.assertEqual(self.overlay.get('shared'), 1)
+        socket.rate(second=3)
+        self.assertEqual(self.overlay.get('shared'), 2)
+        self.assertEqual(self.overlay.get('other'), 3)
+        self.assertIsNone(self.overlay.get('missing'))
+        self.assertEqual(self.mp.get('shared'), 1)
+        self.assertEqual(self.mp['shared'].rating('second'), 1)
+
+    def test_adapter(self):
+        socket = self.overlay.switch_on('shared')
+        self.assertEqual(str(socket), "<AdapterOverlay 'shared'>")
+        self.assertEqual(socket.plug_in('third', 3), 3)
+        with self.assertRaises(KeyError):
+            socket.plug_in('first', 10)
+        with self.assertRaises(KeyError):
+            socket.rate(missing=1)
+        socket['first'] = 10
+        socket.rate(third=1)
+        self.assertEqual(list(socket), ['first', 'second', 'third'])
+        self.assertEqual(len(socket), 3)
+        self.assertEqual(socket['first'], 10)
+        self.assertEqual(socket['second'], 2)
+        self.assertEqual(socket.rating('third'), 1)
+        with self.assertRaises(KeyError):
+            socket.rating('missing')
+        self.assertEqual(socket.top(2), [('first', 10), ('second', 2)])
+        with self.assertRaises(ValueError):
+            socket.top(4)
+        self.assertNotIn('third', self.mp['shared'])
+        self.assertEqual(self.mp['shared']['first'], 1)
+
+    def test_concurrent_plug_in(self):
+        socket = self.overlay.switch_on('shared')
+        plugged = list()
+        start = threading.Event()
+
+        def plug_in(plug):
+            start.wait()
+            try:
+                plugged.append(socket.plug_in('tenant', plug))
+            except KeyError:
+                pass
+
+        threads = [threading.Thread(target=plug_in, args=(plug,))
+                   for plug in range(16)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(plugged), 1)
+        self.assertEqual(socket['tenant'], plugged[0])
+
+    def test_missing_socket(self):
+        socket = self.overlay.switch_on('new')
+        self.assertIsNone(socket.base)
+        with self.assertRaises(ValueError):
+            socket.highest_rated
+        with self.assertRaises(KeyError):
+            socket['missing']
+        socket.plug_in('new', 4)
+        self.assertEqual(self.overlay.get('new'), 4)
+        self.assertEqual(list(self.overlay), ['shared', 'other', 'new'])
+        self.assertEqual(len(self.overlay), 3)
+        with self.assertRaises(KeyError):
+            self.overlay['missing']
+        self.assertNotIn('new', self.mp)
+
+    def test_empty_socket(self):
+        self.overlay.switch_on('missing')
+        self.assertEqual(self.overlay.get('missing', 'DEFAULT'), 'DEFAULT')
+        self.overlay.switch_on('other')
+        self.assertEqual(self.overlay.get('other'), 3)
+        self.mp.switch_on('empty')
+        self.overlay.switch_on('empty')
+        with self.assertRaises(ValueError):
+            self.overlay.get('empty')
+
+    def test_getitem(self):
+        other = self.overlay['other']
+        self.assertIsNot(other, self.mp['other'])
+        self.assertIsInstance(other, multipla.AdapterOverlay)
+        self.assertIs(other, self.overlay.switch_on('other'))
+        self.assertIs(other.base, self.mp['other'])
+        other.plug_in('overlay', 5)
+        other.rate(overlay=1)
+        self.assertEqual(self.overlay.get('other'), 5)
+        self.assertEqual(list(self.mp['other']), ['only'])
+        self.assertEqual(self.mp.get('other'), 3)
+        nested = self.overlay.overlay()
+        self.assertIs(nested['shared'].base, self.overlay['shared'])
+
+    def test_nested(self):
+        self.overlay.switch_on('shared').rate(second=3)
+        nested = self.overlay.overlay()
+        self.assertIs(nested.root, self.mp)
+        self.assertEqual(nested.get('shared'), 2)
+        nested.switch_on('shared').rate(first=4)
+        self.assertEqual(nested.get('shared'), 1)
+        self.assertEqual(self.overlay.get('shared'), 2)
+
+    def test_activate(self):
+        self.overlay.switch_on('shared').rate(second=3)
+        self.assertEqual(self.mp.get('shared'), 1)
+        with self.overlay.activate() as active:
+            self.assertIs(active, self.overlay)
+            self.assertEqual(self.mp.get('shared'), 2)
+            self.assertEqual(multipla.Multipla('test').get('shared'), None)
+        self.assertEqual(self.mp.get('shared'), 1)
+
+
+class FakeEntryPoint(object):
+    def __init__(self, dist, extras=(), activate=None):
+        self.dist = dist
+        self.extras = extras
+        self.activate = activate
+        self.required = 0
+
+    def require(self):
+        self.required += 1
+        if self.activate is not None:
+            pkg_resources.working_set.add(self.activate)
+
+
+class CountingDistribution(pkg_resources.Distribution):
+    "A distribution without requirements, counting their resolutions."
+
+    def __init__(self, group, *entry_points, **kwargs):
+        super(CountingDistribution, self).__init__(**kwargs)
+        self.resolved = 0
+        self._ep_map = {group: dict(
+            (ep.name, ep) for ep in (pkg_resources.EntryPoint.parse(
+                entry_point, dist=self) for entry_point in entry_points))}
+
+    def requires(self, extras=()):
+        self.resolved += 1
+        return []
+
 
 class TestModuleFunctions(unittest.TestCase):
 
+    def distribution(self, version):
+        return CountingDistribution('test', 'join = os.path:join',
+                                    'getcwd = os:getcwd',
+                                    project_name='multipla-test',
+                                    version=version)
+
+    def test_multipla_call(self):
+        dist = self.distribution('1.0')
+        mp = multipla.Multipla('test')
+        mp(dist)
+        self.assertEqual(dist.resolved, 1)
+        self.assertIs(mp.get('join'), os.path.join)
+        self.assertIs(mp['getcwd']['os:getcwd'], os.getcwd)
+        dist = self.distribution('2.0')
+        trusted = multipla.Multipla('test')
+        trusted.trusted = True
+        trusted(dist)
+        self.assertEqual(dist.resolved, 0)
+        self.assertIs(trusted.get('join'), os.path.join)
+
+    def test__generation(self):
+        working_set = pkg_resources.WorkingSet([])
+        generation = multipla._generation(working_set)
+        self.assertEqual(multipla._generation(working_set), generation)
+        working_set.add(self.distribution('1.0'), 'test')
+        added = multipla._generation(working_set)
+        self.assertGreater(added, generation)
+        working_set.add(self.distribution('2.0'), 'test', replace=True)
+        self.assertGreater(multipla._generation(working_set), added)
+
+    def test_freeze(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        package = os.path.join(directory, 'frozen_plugs')
+        os.mkdir(package)
+        for name, source in (('__init__.py', ''),
+                             ('codec.py', 'from . import helper\n'
+                                          'encode = helper.upper\n'),
+                             ('helper.py', 'upper = str.upper\n'),
+                             ('data.txt', 'data')):
+            with open(os.path.join(package, name), 'w') as module:
+                module.write(source)
+        sys.path.insert(0, directory)
+        self.addCleanup(sys.path.remove, directory)
+        group = multipla.power_up('test.freeze', pkg_resources.WorkingSet([]))
+        codec = group.switch_on('codec')
+        codec.plug_in('frozen_plugs.codec:encode', str.upper)
+        codec.plug_in('runtime', str.lower)
+        codec.rate({'frozen_plugs.codec:encode': 2})
+        group.switch_on('dumps').plug_in('json:dumps', json.dumps)
+        group.rate(codec=1)
+        bundle = os.path.join(directory, 'bundle.zip')
+        manifest = multipla.freeze(bundle, 'test.freeze')
+        self.assertEqual(manifest, {
+            'magic': multipla._magic(),
+            'groups': {'test.freeze': [
+                ['codec', 1, [['frozen_plugs.codec:encode', 2]]],
+                ['dumps', 0, [['json:dumps', 0]]]]}})
+        self.assertEqual(sorted(zipfile.ZipFile(bundle).namelist()), [
+            'frozen_plugs/__init__.pyc', 'frozen_plugs/codec.pyc',
+            'frozen_plugs/data.txt', 'frozen_plugs/helper.pyc',
+            'multipla.json'])
+
+        # Pretend it's a fresh process, where nothing has been imported yet.
+        shutil.rmtree(package)
+        del multipla._register['test.freeze']
+        for name in ('frozen_plugs', 'frozen_plugs.codec',
+                     'frozen_plugs.helper'):
+            sys.modules.pop(name, None)
+        self.addCleanup(sys.path.remove, bundle)
+        # Neither importing multipla, nor loading a bundle, must import
+        # pkg_resources (which scans all the distributions): check it with
+        # a fresh copy of the module.
+        cold = types.ModuleType('multipla_cold')
+        source = multipla._source(multipla.__file__)
+        sys.modules['pkg_resources'] = None
+        try:
+            with open(source) as module:
+                exec(compile(module.read(), source, 'exec'), cold.__dict__)
+            codec = cold.power_up('test.freeze', bundle=bundle).get('codec')
+        finally:
+            sys.modules['pkg_resources'] = pkg_resources
+        self.assertEqual(codec('test'), 'TEST')
+        frozen = multipla.power_up('test.freeze', bundle=bundle)
+        self.assertIs(frozen, multipla.power_up('test.freeze', bundle=bundle))
+        self.assertEqual(frozen.get('codec')('test'), 'TEST')
+        self.assertEqual(frozen['codec'].rating('frozen_plugs.codec:encode'), 2)
+        self.assertTrue(sys.modules['frozen_plugs.codec'].__file__.startswith(
+            bundle))
+        with self.assertRaises(KeyError):
+            multipla.power_up('test.missing', bundle=bundle)
+        with self.assertRaises(TypeError):
+            multipla.power_up('test.freeze', unexpected=True)
+        self.assertIs(frozen.get('dumps'), json.dumps)
+
+        # The same distribution may still be found in a working set.
+        dist = CountingDistribution(
+            'test.freeze', 'codec = frozen_plugs.codec:encode',
+            'dumps = json:dumps', 'loads = json:loads',
+            project_name='multipla-frozen', version='1.0')
+        working_set = pkg_resources.WorkingSet([])
+        working_set.add(dist, 'frozen')
+        self.assertIs(multipla.power_up('test.freeze', working_set), frozen)
+        self.assertEqual(list(frozen['codec']), ['frozen_plugs.codec:encode'])
+        self.assertEqual(frozen['codec'].rating('frozen_plugs.codec:encode'), 2)
+        self.assertIs(frozen.get('loads'), json.loads)
+        self.assertEqual(dist.resolved, 1)
+
+        stale = os.path.join(directory, 'stale.zip')
+        with zipfile.ZipFile(stale, 'w') as archive:
+            manifest['magic'] = '00000000'
+            archive.writestr('multipla.json', json.dumps(manifest))
+        with self.assertRaises(ValueError):
+            multipla.power_up('test.stale', bundle=stale)
+        self.assertNotIn(stale, sys.path)
+
+    def test__require(self):
+        dist = object()
+        first, second = FakeEntryPoint(dist), FakeEntryPoint(dist)
+        extra = FakeEntryPoint(dist, ('extra',))
+        for entry_point in (first, second, extra, first):
+            multipla._require(entry_point)
+        self.assertEqual(first.required, 1)
+        self.assertEqual(second.required, 0)
+        self.assertEqual(extra.required, 1)
+        orphan = FakeEntryPoint(None)
+        multipla._require(orphan)
+        multipla._require(orphan)
+        self.assertEqual(orphan.required, 2)
+
+    def test__require_activates(self):
+        dist = object()
+        activated = CountingDistribution(
+            'test', project_name='multipla-activated', version='1.0')
+        self.addCleanup(self.deactivate, activated)
+        first = FakeEntryPoint(dist, activate=activated)
+        second = FakeEntryPoint(dist)
+        multipla._require(first)
+        multipla._require(second)
+        self.assertEqual((first.required, second.required), (1, 0))
+
+    def deactivate(self, dist):
+        working_set = pkg_resources.working_set
+        working_set.by_key.pop(dist.key, None)
+        for keys in working_set.entry_keys.values():
+            if dist.key in keys:
+                keys.remove(dist.key)
+
     def test_power_up(self):
         test = multipla.power_up('test', pkg_resources.working_set)
         self.assertIs(test, multipla.power_up('test'))
         self.assertIsInstance(test, multipla.Multipla)
 
+    def test_power_up_subscribes_once(self):
+        working_set = pkg_resources.WorkingSet([])
+        subscribers = len(working_set.callbacks)
+        first = multipla.power_up('test.subscribe.first', working_set)
+        self.assertEqual(len(working_set.callbacks), subscribers + 1)
+        multipla.power_up('test.subscribe.first', working_set)
+        self.assertEqual(len(working_set.callbacks), subscribers + 1)
+        # Empty groups compare equal, yet both are subscribed.
+        second = multipla.power_up('test.subscribe.second', working_set)
+        self.assertEqual(first, second)
+        self.assertEqual(len(working_set.callbacks), subscribers + 2)
+        working_set.add(CountingDistribution(
+            'test.subscribe.second', 'getcwd = os:getcwd',
+            project_name='multipla-test', version='1.0'), 'test')
+        self.assertNotIn('getcwd', first)
+        self.assertIs(second['getcwd'].highest_rated, os.getcwd)
+
+
+class TestStress(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here, so that the harness can't break the collection.
+        self.stress = multipla.importlib.import_module('stress_multipla')
+        self.groups = ['stress.{}'.format(group)
+                       for group in range(self.stress.GROUPS)]
+        self.addCleanup(self.unregister)
+        self.unregister()
+
+    def unregister(self):
+        for group in self.groups:
+            multipla._register.pop(group, None)
+
+    def test_hammer(self):
+        working_set = self.stress.working_set()
+        seconds, seen = self.stress.hammer(working_set, 8, 500)
+        self.assertFalse(self.stress.check(seen))
+        self.assertFalse(self.stress.unpopulated())
+        self.assertEqual(len(seen), self.stress.GROUPS * (
+            1 + self.stress.SOCKETS // self.stress.GROUPS))
+        for group in self.groups:
+            self.assertEqual(len(multipla._register[group]),
+                             self.stress.SOCKETS)
+
 
 if __name__ == '__main__':
     unittest.main()